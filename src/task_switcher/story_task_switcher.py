@@ -5,9 +5,34 @@
 # @Last Modified by:   Andreas Paepcke
 # @Last Modified time: 2026-01-31 12:50:09
 
-from flask import Flask, render_template_string, jsonify
+from flask import Flask, Response, render_template_string, jsonify, request
+import errno
+import gzip
+import hashlib
+import json
+import logging
+import math
+import os
+import queue
+import select
 import subprocess
 import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+try:
+    import dbus
+except ImportError:
+    dbus = None
+
+try:
+    from gi.repository import GLib
+    from dbus.mainloop.glib import DBusGMainLoop
+    import dbus.mainloop.glib
+except ImportError:
+    GLib = None
 
 
 class AIServiceController:
@@ -17,6 +42,41 @@ class AIServiceController:
     """
     SERVER_IP = '192.168.1.111'
     
+    # Seconds for which a snapshot of the active services is reused
+    STATE_CACHE_TTL = 1.0
+    
+    # Seconds between service state checks when systemd signals
+    # cannot be used to drive the /events stream
+    STATUS_POLL_INTERVAL = 2.0
+    
+    # Seconds of silence after which an /events stream sends a comment
+    # line, so that connections of closed browser tabs get noticed
+    EVENTS_KEEPALIVE = 15.0
+    
+    # Seconds a single port probe waits for the TCP handshake
+    PORT_CHECK_TIMEOUT = 1.0
+    
+    # Seconds between port probes while waiting for a service
+    PORT_POLL_INTERVAL = 0.25
+    
+    # Upper bound on the seconds a request may wait for a service port
+    MAX_READY_WAIT = 60.0
+    
+    # Seconds between checks whether queued systemd jobs have finished
+    JOB_POLL_INTERVAL = 0.1
+    
+    # Waitress settings; see run(). SERVER_THREADS is only the
+    # default of run()'s threads argument
+    SERVER_THREADS = 16
+    SERVER_CONNECTION_LIMIT = 200
+    SERVER_CHANNEL_TIMEOUT = 30
+    
+    # PID of the process that last made sure SillyTavern is running
+    _silly_checked_pid: int | None = None
+    
+    SYSTEMD_BUS_NAME = 'org.freedesktop.systemd1'
+    SYSTEMD_OBJECT_PATH = '/org/freedesktop/systemd1'
+    
     # HTML template for the web interface
     HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -77,43 +137,36 @@ class AIServiceController:
             loadingText.textContent = `Starting ${serviceName}...`;
             
             try {
-                // Trigger the service switch first
-                await fetch(`/focus/${mode}`);
-                
-                // Map mode to service name for checking
-                const serviceCheckName = mode === 'art' ? 'comfy' : 'silly';
-                
-                // Poll until service is ready (max 60 seconds)
-                const maxAttempts = 120;
+                // Switch services; the server answers once the service
+                // is ready (max 60 seconds). Count up the elapsed time meanwhile.
+                const started = Date.now();
+                const ticker = setInterval(() => {
+                    const elapsed = Math.floor((Date.now() - started) / 1000);
+                    const dots = '.'.repeat((elapsed % 3) + 1);
+                    loadingText.textContent = `Waiting for ${serviceName}${dots} (${elapsed}s)`;
+                }, 500);
                 let serviceReady = false;
+                let switchFailed = false;
                 
-                for (let i = 0; i < maxAttempts; i++) {
-                    try {
-                        const response = await fetch(`/check_ready/${serviceCheckName}`);
-                        const data = await response.json();
-                        
-                        if (data.ready) {
-                            serviceReady = true;
-                            loadingText.textContent = `${serviceName} ready! Opening...`;
-                            await new Promise(r => setTimeout(r, 500));
-                            break;
-                        }
-                    } catch (e) {
-                        // Continue waiting
-                    }
-                    
-                    // Update progress
-                    const dots = '.'.repeat((i % 3) + 1);
-                    const elapsed = Math.floor(i / 2);
-                    loadingText.textContent = `Waiting for ${serviceName}${dots} (${elapsed}s)`;
-                    await new Promise(r => setTimeout(r, 500));
+                try {
+                    const response = await fetch(`/focus/${mode}`);
+                    serviceReady = response.ok;
+                    switchFailed = response.status === 500;
+                } catch (e) {
+                    // Open the tab anyway
+                } finally {
+                    clearInterval(ticker);
                 }
                 
-                if (!serviceReady) {
-                    loadingText.textContent = `Opening ${serviceName}...`;
-                    await new Promise(r => setTimeout(r, 500));
+                if (switchFailed) {
+                    throw new Error(`Could not switch to ${serviceName}`);
                 }
                 
+                loadingText.textContent = serviceReady
+                    ? `${serviceName} ready! Opening...`
+                    : `Opening ${serviceName}...`;
+                await new Promise(r => setTimeout(r, 500));
+                
                 // Open the tab
                 const newTab = window.open(url, tabName);
                 
@@ -128,17 +181,48 @@ class AIServiceController:
             }
         }
         
-        async function updateStatus() {
-            const response = await fetch('/status');
-            const data = await response.json();
-            
+        function showStatus(data) {
             document.getElementById('led-comfy').className = data.comfy ? 'led led-on' : 'led';
             document.getElementById('led-tabby').className = data.tabby ? 'led led-on' : 'led';
         }
         
-        // Poll every 2 seconds
-        setInterval(updateStatus, 2000);
-        window.onload = updateStatus;
+        async function updateStatus() {
+            const response = await fetch('/status');
+            showStatus(await response.json());
+        }
+        
+        // Server pushes the current state, then every change. Hidden tabs
+        // close their stream, so that background tabs hold neither one of
+        // the browser's few connections per host nor a server thread.
+        let events = null;
+        
+        function openEvents() {
+            if (events === null && !document.hidden) {
+                events = new EventSource('/events');
+                events.onmessage = e => showStatus(JSON.parse(e.data));
+            }
+        }
+        
+        function closeEvents() {
+            if (events !== null) {
+                events.close();
+                events = null;
+            }
+        }
+        
+        window.onload = () => {
+            if (window.EventSource) {
+                document.addEventListener('visibilitychange',
+                    () => document.hidden ? closeEvents() : openEvents());
+                window.addEventListener('pagehide', closeEvents);
+                window.addEventListener('pageshow', openEvents);
+                openEvents();
+            } else {
+                // Poll every 2 seconds
+                updateStatus();
+                setInterval(updateStatus, 2000);
+            }
+        };
     </script>
 </head>
 <body>
@@ -190,6 +274,32 @@ class AIServiceController:
             'silly': 'silly-tavern'
         }
         
+        # Persistent connection to systemd; None if D-Bus is unavailable,
+        # in which case we shell out to systemctl instead
+        self._bus, self._systemd = self._connect_systemd()
+        
+        # (monotonic timestamp, names of active services) of the last query
+        self._active_units: tuple[float, set[str]] | None = None
+        # Bumped by _invalidate_states(), so that queries running
+        # across an invalidation do not store their outdated result
+        self._state_generation = 0
+        self._state_lock = threading.Lock()
+        # Held by the one thread that refreshes the snapshot
+        self._refresh_lock = threading.Lock()
+        
+        # One queue per connected /events client, fed by a single
+        # watcher thread that is started with the first client
+        self._subscribers: list[queue.Queue] = []
+        self._subscribers_lock = threading.Lock()
+        self._last_states: dict[str, bool] | None = None
+        self._watcher: threading.Thread | None = None
+        
+        # Ports probed by /check_ready, by service key
+        self._port_map = {
+            'comfy': self.comfy_port,
+            'silly': self.silly_tavern_port
+        }
+        
         # Build URLs
         self.comfy_url = f"http://{self.server_ip}:{self.comfy_port}"
         self.st_url = f"http://{self.server_ip}:{self.silly_tavern_port}"
@@ -198,8 +308,48 @@ class AIServiceController:
         self.app = Flask(__name__)
         self._register_routes()
         
-        # Ensure that the Silly Tavern Web UI is running on the server
-        self._start_service(self.services['silly'])
+        # Every template value is fixed for the life of the controller,
+        # so render the page once instead of on each request
+        with self.app.app_context():
+            self._index_html = render_template_string(
+                self.HTML_TEMPLATE,
+                comfy_url=self.comfy_url,
+                st_url=self.st_url,
+                comfy_port=self.comfy_port,
+                st_port=self.silly_tavern_port,
+                server_ip=self.server_ip,
+                machine_name=self.machine_name
+            )
+        self._index_etag = hashlib.md5(self._index_html.encode('utf-8')).hexdigest()
+        # Compressed once here, so no request pays for compression
+        self._index_gz = gzip.compress(self._index_html.encode('utf-8'), 9)
+        
+        # Ensure that the Silly Tavern Web UI is running on the server;
+        # once per process is enough, even with several controllers
+        if AIServiceController._silly_checked_pid != os.getpid():
+            if not self._is_service_active(self.services['silly']):
+                self._start_services(self.services['silly'])
+            AIServiceController._silly_checked_pid = os.getpid()
+    
+    def _connect_systemd(self) -> tuple:
+        """
+        Open a system bus connection and get the systemd manager proxy.
+        
+        Returns:
+            Tuple (bus, manager), or (None, None) if D-Bus is not available
+        """
+        if dbus is None:
+            return None, None
+        try:
+            bus = dbus.SystemBus()
+            manager = dbus.Interface(
+                bus.get_object(self.SYSTEMD_BUS_NAME, self.SYSTEMD_OBJECT_PATH),
+                'org.freedesktop.systemd1.Manager'
+            )
+            return bus, manager
+        except dbus.DBusException as e:
+            logger.warning("D-Bus unavailable, falling back to systemctl: %s", e)
+            return None, None
     
     def _is_service_active(self, service_name: str) -> bool:
         """
@@ -211,12 +361,182 @@ class AIServiceController:
         Returns:
             True if service is active, False otherwise
         """
-        result = subprocess.call(
-            ["systemctl", "is-active", "--quiet", service_name],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL
+        return service_name in self._active_unit_set()
+    
+    def _active_unit_set(self) -> set[str]:
+        """
+        Get the names of all active services, without the '.service'
+        suffix. A snapshot younger than STATE_CACHE_TTL seconds is
+        reused, so that status polls from many browser tabs share one
+        query, whatever the number of services checked.
+        
+        Returns:
+            Set of active service names
+        """
+        cached = self._fresh_active_units()
+        if cached is not None:
+            return cached
+        
+        # Only one thread queries systemd; the others wait for its
+        # result instead of each running their own query
+        with self._refresh_lock:
+            with self._state_lock:
+                cached = self._fresh_active_units()
+                if cached is not None:
+                    return cached
+                generation = self._state_generation
+            
+            active = self._query_active_units()
+            with self._state_lock:
+                # If a start or stop invalidated the states while we
+                # were querying, our result may predate it
+                if self._state_generation == generation:
+                    self._active_units = (time.monotonic(), active)
+        return active
+    
+    def _fresh_active_units(self) -> set[str] | None:
+        """
+        Get the cached snapshot of active services if it is younger
+        than STATE_CACHE_TTL seconds.
+        
+        Returns:
+            Set of active service names, or None if there is no fresh snapshot
+        """
+        if (self._active_units is not None
+                and time.monotonic() - self._active_units[0] < self.STATE_CACHE_TTL):
+            return self._active_units[1]
+        return None
+    
+    def _query_active_units(self) -> set[str]:
+        """
+        Ask systemd for the active services, bypassing the snapshot cache.
+        
+        Returns:
+            Set of active service names
+        """
+        if self._systemd is not None:
+            try:
+                units = self._systemd.ListUnitsByPatterns(['active'], ['*.service'])
+                return {str(unit[0]).removesuffix('.service') for unit in units}
+            except dbus.DBusException:
+                pass
+        result = subprocess.run(
+            ["systemctl", "list-units", "--type=service", "--state=active",
+             "--no-legend", "--no-pager", "--plain"],
+            capture_output=True,
+            text=True
         )
-        return result == 0
+        return {line.split()[0].removesuffix('.service')
+                for line in result.stdout.splitlines() if line}
+    
+    def _invalidate_states(self) -> None:
+        """
+        Drop the cached snapshot of active services, so that the next
+        status query sees the effect of a start or stop right away.
+        """
+        with self._state_lock:
+            self._active_units = None
+            self._state_generation += 1
+    
+    def _service_states(self) -> dict[str, bool]:
+        """
+        Get the states shown by the web interface's LEDs.
+        
+        Returns:
+            Dict with keys 'comfy' and 'tabby', True for active services
+        """
+        active = self._active_unit_set()
+        return {
+            "comfy": self.services['comfy'] in active,
+            "tabby": self.services['tabby'] in active
+        }
+    
+    def _publish_states(self, states: dict[str, bool]) -> None:
+        """
+        Send service states to all /events clients if they differ from
+        the states last sent.
+        
+        Args:
+            states: Dict as returned by _service_states()
+        """
+        with self._subscribers_lock:
+            if states == self._last_states:
+                return
+            self._last_states = dict(states)
+            message = json.dumps(states)
+            for subscriber in self._subscribers:
+                subscriber.put(message)
+    
+    def _ensure_watcher(self) -> None:
+        """Start the service state watcher thread unless it is running."""
+        with self._subscribers_lock:
+            if self._watcher is not None and self._watcher.is_alive():
+                return
+            self._watcher = threading.Thread(target=self._watch_services,
+                                             name='service-watcher',
+                                             daemon=True)
+            self._watcher.start()
+    
+    def _watch_services(self) -> None:
+        """
+        Thread target that publishes service state changes to /events
+        clients. Listens for systemd's PropertiesChanged signals if
+        D-Bus and GLib are available, else polls every
+        STATUS_POLL_INTERVAL seconds.
+        """
+        self._publish_states(self._service_states())
+        if self._systemd is not None and GLib is not None:
+            try:
+                self._watch_signals()
+                return
+            except dbus.DBusException as e:
+                logger.warning("Cannot watch systemd signals, polling instead: %s", e)
+        while True:
+            time.sleep(self.STATUS_POLL_INTERVAL)
+            with self._subscribers_lock:
+                if not self._subscribers:
+                    # Nobody listens, so skip the query; the states
+                    # last sent go stale and must not be reused
+                    self._last_states = None
+                    continue
+            self._publish_states(self._service_states())
+    
+    def _watch_signals(self) -> None:
+        """
+        Run a GLib main loop that turns the units' PropertiesChanged
+        signals into /events messages. Does not return.
+        
+        Raises:
+            dbus.DBusException: if subscribing to the signals fails
+        """
+        dbus.mainloop.glib.threads_init()
+        # Private connection, since signals need a main loop attached
+        bus = dbus.SystemBus(mainloop=DBusGMainLoop(), private=True)
+        manager = dbus.Interface(
+            bus.get_object(self.SYSTEMD_BUS_NAME, self.SYSTEMD_OBJECT_PATH),
+            'org.freedesktop.systemd1.Manager'
+        )
+        # systemd only emits unit signals while someone is subscribed
+        manager.Subscribe()
+        
+        for key in ('comfy', 'tabby'):
+            path = manager.LoadUnit(f"{self.services[key]}.service")
+            
+            def on_change(interface, changed, invalidated, key=key):
+                if (interface != 'org.freedesktop.systemd1.Unit'
+                        or 'ActiveState' not in changed):
+                    return
+                self._invalidate_states()
+                states = dict(self._last_states or self._service_states())
+                states[key] = changed['ActiveState'] == 'active'
+                self._publish_states(states)
+            
+            bus.add_signal_receiver(on_change,
+                                    signal_name='PropertiesChanged',
+                                    dbus_interface=dbus.PROPERTIES_IFACE,
+                                    bus_name=self.SYSTEMD_BUS_NAME,
+                                    path=path)
+        GLib.MainLoop().run()
     
     def _is_port_ready(self, port: int) -> bool:
         """
@@ -228,119 +548,295 @@ class AIServiceController:
         Returns:
             True if port is accepting connections, False otherwise
         """
-        try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.settimeout(1.0)  # Increased timeout
-            result = sock.connect_ex(('127.0.0.1', port))  # Check localhost, not remote IP
-            sock.close()
-            return result == 0
-        except Exception as e:
-            print(f"Port check error for {port}: {e}")
-            return False
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.setblocking(False)
+            err = sock.connect_ex(('127.0.0.1', port))  # Check localhost, not remote IP
+            if err == errno.EINPROGRESS:
+                # Even on localhost the handshake may not finish in connect()
+                _, writable, _ = select.select([], [sock], [], self.PORT_CHECK_TIMEOUT)
+                if not writable:
+                    return False
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            return err in (0, errno.EISCONN)
     
-    def _stop_service(self, service_name: str) -> bool:
+    def _wait_for_port(self, port: int, timeout: float) -> bool:
         """
-        Stop a systemctl service.
+        Wait until a port accepts connections.
         
         Args:
-            service_name: Name of the systemd service
+            port: Port number to check
+            timeout: Maximum number of seconds to wait
+            
+        Returns:
+            True if port is accepting connections, False on timeout
+        """
+        deadline = time.monotonic() + timeout
+        while not self._is_port_ready(port):
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.PORT_POLL_INTERVAL)
+        return True
+    
+    def _run_unit_job(self, verb: str, *service_names: str) -> bool:
+        """
+        Start or stop services and wait until systemd is done. Through
+        sudo, all services go into one systemctl call, and thus one
+        systemd transaction; over D-Bus, one job is queued per service.
+        
+        Args:
+            verb: Either 'start' or 'stop'
+            service_names: Names of the systemd services
             
         Returns:
             True if successful, False otherwise
         """
+        if self._systemd is not None:
+            method = self._systemd.StartUnit if verb == 'start' else self._systemd.StopUnit
+            try:
+                job_paths = [str(method(f"{service_name}.service", 'replace'))
+                             for service_name in service_names]
+            except dbus.DBusException:
+                # Typically access denied by polkit; sudo may still work.
+                # Services queued before the failure are passed to sudo
+                # again, which is harmless: systemd merges the new job
+                # into the one already queued for the same unit.
+                pass
+            else:
+                return self._wait_for_jobs(verb, service_names, job_paths)
         result = subprocess.run(
-            ["/usr/bin/sudo", "/usr/bin/systemctl", "stop", service_name],
-            capture_output=True
+            ["/usr/bin/sudo", "/usr/bin/systemctl", verb, *service_names],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=False
         )
         return result.returncode == 0
     
-    def _start_service(self, service_name: str) -> bool:
+    def _wait_for_jobs(self, verb: str, service_names: tuple[str, ...], job_paths: list[str]) -> bool:
         """
-        Start a systemctl service.
+        Wait for systemd jobs queued over D-Bus, then check their effect.
         
         Args:
-            service_name: Name of the systemd service
+            verb: Either 'start' or 'stop'
+            service_names: Names of the systemd services the jobs are for
+            job_paths: Object paths of the queued jobs
+            
+        Returns:
+            True if all services ended up in the state the verb asks for
+        """
+        # StartUnit/StopUnit only queue a job; it is done once it
+        # no longer shows up among systemd's jobs
+        while True:
+            try:
+                queued = {str(queued_job[4]) for queued_job in self._systemd.ListJobs()}
+            except dbus.DBusException:
+                return False
+            if queued.isdisjoint(job_paths):
+                break
+            time.sleep(self.JOB_POLL_INTERVAL)
+        
+        active = self._query_active_units()
+        if verb == 'start':
+            return all(name in active for name in service_names)
+        return not any(name in active for name in service_names)
+    
+    def _stop_services(self, *service_names: str) -> bool:
+        """
+        Stop systemctl services.
+        
+        Args:
+            service_names: Names of the systemd services
             
         Returns:
             True if successful, False otherwise
         """
-        result = subprocess.run(
-            ["/usr/bin/sudo", "/usr/bin/systemctl", "start", service_name],
-            capture_output=True
-        )
-        return result.returncode == 0
+        return self._run_unit_job('stop', *service_names)
     
-    def _switch_to_art_mode(self) -> None:
-        """Switch to art generation mode (ComfyUI active, TabbyAPI stopped)."""
-        self._stop_service(self.services['tabby'])
-        self._start_service(self.services['comfy'])
+    def _start_services(self, *service_names: str) -> bool:
+        """
+        Start systemctl services.
+        
+        Args:
+            service_names: Names of the systemd services
+            
+        Returns:
+            True if successful, False otherwise
+        """
+        return self._run_unit_job('start', *service_names)
     
-    def _switch_to_story_mode(self) -> None:
-        """Switch to story writing mode (TabbyAPI active, ComfyUI stopped)."""
-        self._stop_service(self.services['comfy'])
-        self._start_service(self.services['tabby'])
-        self._start_service(self.services['silly'])
+    def _switch_to_art_mode(self) -> bool:
+        """
+        Switch to art generation mode (ComfyUI active, TabbyAPI stopped).
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        return self._switch_services(stop=(self.services['tabby'],),
+                                     start=(self.services['comfy'],))
+    
+    def _switch_to_story_mode(self) -> bool:
+        """
+        Switch to story writing mode (TabbyAPI active, ComfyUI stopped).
+        
+        Returns:
+            True if successful, False otherwise
+        """
+        return self._switch_services(stop=(self.services['comfy'],),
+                                     start=(self.services['tabby'], self.services['silly']))
+    
+    def _switch_services(self, stop: tuple[str, ...], start: tuple[str, ...]) -> bool:
+        """
+        Stop some services, then start others. The start is skipped if
+        the stop fails, so that the services never compete for VRAM.
+        
+        Args:
+            stop: Names of the systemd services to stop
+            start: Names of the systemd services to start
+            
+        Returns:
+            True if successful, False otherwise
+        """
+        try:
+            if not self._stop_services(*stop):
+                logger.warning("Could not stop %s; not starting %s",
+                               ', '.join(stop), ', '.join(start))
+                return False
+            if not self._start_services(*start):
+                logger.warning("Could not start %s", ', '.join(start))
+                return False
+            return True
+        finally:
+            self._invalidate_states()
     
     def _register_routes(self) -> None:
         """Register Flask routes."""
         
         @self.app.route('/')
         def index():
-            return render_template_string(
-                self.HTML_TEMPLATE,
-                comfy_url=self.comfy_url,
-                st_url=self.st_url,
-                comfy_port=self.comfy_port,
-                st_port=self.silly_tavern_port,
-                server_ip=self.server_ip,
-                machine_name=self.machine_name
-            )
+            use_gzip = request.accept_encodings['gzip'] > 0
+            # The gzipped page is a different representation, so it
+            # needs its own ETag
+            etag = f"{self._index_etag}-gzip" if use_gzip else self._index_etag
+            headers = {
+                'Content-Type': 'text/html; charset=utf-8',
+                'Cache-Control': 'public, max-age=3600',
+                'ETag': f'"{etag}"',
+                'Vary': 'Accept-Encoding'
+            }
+            if request.if_none_match.contains(etag):
+                return '', 304, headers
+            if use_gzip:
+                headers['Content-Encoding'] = 'gzip'
+                return self._index_gz, 200, headers
+            return self._index_html, 200, headers
         
         @self.app.route('/status')
         def get_status():
-            return jsonify({
-                "comfy": self._is_service_active(self.services['comfy']),
-                "tabby": self._is_service_active(self.services['tabby'])
-            })
+            return jsonify(self._service_states())
+        
+        @self.app.route('/events')
+        def events():
+            """Server-Sent Events stream of service state changes"""
+            def stream():
+                # Registered only once the response is being sent, and
+                # always removed again, so no queue outlives its client
+                subscriber = queue.Queue()
+                with self._subscribers_lock:
+                    have_states = self._last_states is not None
+                    if have_states:
+                        subscriber.put(json.dumps(self._last_states))
+                    self._subscribers.append(subscriber)
+                try:
+                    if not have_states:
+                        # Send the current states now rather than at
+                        # the watcher's next poll
+                        self._publish_states(self._service_states())
+                    self._ensure_watcher()
+                    while True:
+                        try:
+                            message = subscriber.get(timeout=self.EVENTS_KEEPALIVE)
+                            yield f"data: {message}\n\n"
+                        except queue.Empty:
+                            yield ": keepalive\n\n"
+                finally:
+                    with self._subscribers_lock:
+                        self._subscribers.remove(subscriber)
+            
+            return Response(stream(), mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache'})
         
         @self.app.route('/check_ready/<service>')
         def check_ready(service):
-            """Check if a service port is accepting connections"""
-            port_map = {
-                'comfy': self.comfy_port,
-                'silly': self.silly_tavern_port
-            }
-            
-            if service not in port_map:
+            """
+            Check if a service port is accepting connections. With a
+            'timeout' query parameter, wait up to that many seconds
+            for the port to open before answering. The page itself
+            waits through /focus; this is a probe for external callers.
+            """
+            port = self._port_map.get(service)
+            if port is None:
                 return jsonify({"ready": False})
             
-            port = port_map[service]
-            is_ready = self._is_port_ready(port)
-            print(f"Checking {service} on port {port}: {is_ready}")  # Debug logging
+            timeout = request.args.get('timeout', 0.0, type=float)
+            if not math.isfinite(timeout):
+                return jsonify({"error": "timeout must be a finite number"}), 400
+            timeout = max(0.0, min(timeout, self.MAX_READY_WAIT))
+            is_ready = self._wait_for_port(port, timeout)
+            logger.debug("check_ready: %s port=%d ready=%s", service, port, is_ready)
             return jsonify({"ready": is_ready})
         
         @self.app.route('/focus/<mode>')
         def switch_mode(mode):
+            """
+            Switch modes, then answer once the mode's web UI accepts
+            connections, or with 504 after MAX_READY_WAIT seconds.
+            Answers 500 right away if a service fails to stop or start.
+            """
             if mode == "art":
-                self._switch_to_art_mode()
+                switched = self._switch_to_art_mode()
+                port = self.comfy_port
             elif mode == "story":
-                self._switch_to_story_mode()
+                switched = self._switch_to_story_mode()
+                port = self.silly_tavern_port
+            else:
+                return '', 204
+            if not switched:
+                return '', 500
+            if not self._wait_for_port(port, self.MAX_READY_WAIT):
+                return '', 504
             return '', 204
     
-    def run(self, host: str = '0.0.0.0', debug: bool = False, use_production_server: bool = False) -> None:
+    def run(self, host: str = '0.0.0.0', debug: bool = False, use_production_server: bool = True,
+            threads: int = SERVER_THREADS) -> None:
         """
         Start the Flask server.
         
+        Waitress handles each request on one of `threads` worker
+        threads. A thread stays busy for the lifetime of every open
+        /events stream, for up to MAX_READY_WAIT seconds on a /focus
+        switch or a /check_ready wait, and for up to PORT_CHECK_TIMEOUT
+        plus a systemctl call on other requests. `threads` must therefore
+        exceed the number of open browser tabs plus concurrent mode
+        switches, or a /focus click hangs until a thread frees up.
+        Independently, browsers allow only about 6 HTTP/1.1 connections
+        per host, so about 6 open tabs of one browser already stall
+        /focus in the browser, whatever the thread count.
+        
         Args:
             host: Host address to bind to
             debug: Enable Flask debug mode
             use_production_server: Use waitress production server instead of Flask dev server
+            threads: Number of waitress worker threads
         """
+        logging.basicConfig(level=logging.DEBUG if debug else logging.INFO)
         if use_production_server:
             try:
                 from waitress import serve
                 print(f"Starting production server on {host}:{self.flask_port}")
-                serve(self.app, host=host, port=self.flask_port)
+                serve(self.app, host=host, port=self.flask_port,
+                      threads=threads,
+                      connection_limit=self.SERVER_CONNECTION_LIMIT,
+                      channel_timeout=self.SERVER_CHANNEL_TIMEOUT)
             except ImportError:
                 print("WARNING: waitress not installed. Install with: pip install waitress")
                 print("Falling back to Flask development server...")
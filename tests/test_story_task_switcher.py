@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Tests for the AIServiceController. systemd is never touched: D-Bus is
+disabled and subprocess.run is replaced by a stub.
+"""
+
+import gzip
+import socket
+import subprocess
+import threading
+import time
+import unittest
+from unittest import mock
+
+from task_switcher import story_task_switcher
+from task_switcher.story_task_switcher import AIServiceController
+
+
+def free_port() -> int:
+    """Return a localhost port that nothing listens on."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+class ControllerTestCase(unittest.TestCase):
+    """Builds a controller whose systemctl calls all go to a stub."""
+
+    ACTIVE_UNITS = "silly-tavern.service loaded active running SillyTavern\n"
+
+    def setUp(self):
+        self.run_calls = []
+        patches = [
+            mock.patch.object(story_task_switcher, 'dbus', None),
+            mock.patch.object(story_task_switcher.subprocess, 'run', self.fake_run),
+            mock.patch.object(AIServiceController, '_silly_checked_pid', None),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.comfy_port = free_port()
+        self.controller = AIServiceController(comfy_port=self.comfy_port,
+                                              silly_tavern_port=free_port())
+        self.client = self.controller.app.test_client()
+
+    def fake_run(self, args, **kwargs):
+        self.run_calls.append(args)
+        return subprocess.CompletedProcess(args, 0, stdout=self.ACTIVE_UNITS, stderr='')
+
+
+class TestActiveUnitCache(ControllerTestCase):
+
+    def test_snapshot_parsed_and_reused(self):
+        self.controller._invalidate_states()
+        self.run_calls.clear()
+        self.assertEqual(self.controller._active_unit_set(), {'silly-tavern'})
+        self.assertEqual(self.controller._active_unit_set(), {'silly-tavern'})
+        self.assertEqual(len(self.run_calls), 1)
+
+    def test_concurrent_readers_share_one_query(self):
+        self.controller._invalidate_states()
+        queries = []
+
+        def slow_query():
+            queries.append(1)
+            time.sleep(0.2)
+            return {'comfyui'}
+
+        with mock.patch.object(self.controller, '_query_active_units', slow_query):
+            threads = [threading.Thread(target=self.controller._service_states)
+                       for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(queries), 1)
+
+    def test_invalidation_during_query_discards_result(self):
+        self.controller._invalidate_states()
+        queries = []
+
+        def query_racing_a_switch():
+            queries.append(1)
+            if len(queries) == 1:
+                # A mode switch finishes while this query runs
+                self.controller._invalidate_states()
+                return {'tabbyapi'}
+            return {'comfyui'}
+
+        with mock.patch.object(self.controller, '_query_active_units', query_racing_a_switch):
+            self.assertEqual(self.controller._active_unit_set(), {'tabbyapi'})
+            self.assertEqual(self.controller._active_unit_set(), {'comfyui'})
+        self.assertEqual(len(queries), 2)
+
+
+class TestUnitJobs(ControllerTestCase):
+
+    def test_dbus_stop_waits_for_job(self):
+        manager = mock.Mock()
+        manager.StopUnit.return_value = '/org/freedesktop/systemd1/job/7'
+        job = (7, 'tabbyapi.service', 'stop', 'running',
+               '/org/freedesktop/systemd1/job/7', '/unit')
+        manager.ListJobs.side_effect = [[job], [job], []]
+        self.controller._systemd = manager
+
+        with mock.patch.object(self.controller, '_query_active_units', return_value=set()), \
+                mock.patch.object(self.controller, 'JOB_POLL_INTERVAL', 0):
+            self.assertTrue(self.controller._stop_services('tabbyapi'))
+        self.assertEqual(manager.ListJobs.call_count, 3)
+
+    def test_dbus_start_reports_failed_unit(self):
+        manager = mock.Mock()
+        manager.StartUnit.return_value = '/org/freedesktop/systemd1/job/8'
+        manager.ListJobs.return_value = []
+        self.controller._systemd = manager
+
+        with mock.patch.object(self.controller, '_query_active_units', return_value=set()):
+            self.assertFalse(self.controller._start_services('comfyui'))
+
+
+class TestPortReady(ControllerTestCase):
+
+    def test_open_port(self):
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as listener:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen()
+            self.assertTrue(self.controller._is_port_ready(listener.getsockname()[1]))
+
+    def test_closed_port(self):
+        self.assertFalse(self.controller._is_port_ready(free_port()))
+
+
+class TestIndex(ControllerTestCase):
+
+    def test_plain(self):
+        response = self.client.get('/', headers={'Accept-Encoding': 'identity'})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.get_data(as_text=True), self.controller._index_html)
+
+    def test_gzip(self):
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response.get_data()).decode('utf-8'),
+                         self.controller._index_html)
+
+    def test_not_modified(self):
+        etag = self.client.get('/').headers['ETag']
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+
+
+class TestCheckReady(ControllerTestCase):
+
+    def test_non_finite_timeouts_rejected(self):
+        for timeout in ('nan', 'inf', '-inf'):
+            response = self.client.get(f'/check_ready/comfy?timeout={timeout}')
+            self.assertEqual(response.status_code, 400, timeout)
+
+    def test_unusable_timeouts_probe_once(self):
+        for timeout in ('-1', 'abc'):
+            started = time.monotonic()
+            response = self.client.get(f'/check_ready/comfy?timeout={timeout}')
+            self.assertEqual(response.status_code, 200, timeout)
+            self.assertEqual(response.get_json(), {"ready": False})
+            self.assertLess(time.monotonic() - started, 1.0)
+
+    def test_unknown_service(self):
+        self.assertEqual(self.client.get('/check_ready/nope').get_json(), {"ready": False})
+
+
+class TestFocus(ControllerTestCase):
+
+    def test_ready(self):
+        with mock.patch.object(self.controller, '_switch_to_art_mode', return_value=True), \
+                mock.patch.object(self.controller, '_wait_for_port', return_value=True):
+            self.assertEqual(self.client.get('/focus/art').status_code, 204)
+
+    def test_not_ready_in_time(self):
+        with mock.patch.object(self.controller, '_switch_to_story_mode', return_value=True), \
+                mock.patch.object(self.controller, '_wait_for_port', return_value=False):
+            self.assertEqual(self.client.get('/focus/story').status_code, 504)
+
+    def test_switch_failed(self):
+        with mock.patch.object(self.controller, '_switch_to_art_mode', return_value=False), \
+                mock.patch.object(self.controller, '_wait_for_port') as wait:
+            self.assertEqual(self.client.get('/focus/art').status_code, 500)
+        wait.assert_not_called()
+
+    def test_start_skipped_after_failed_stop(self):
+        with mock.patch.object(self.controller, '_stop_services', return_value=False), \
+                mock.patch.object(self.controller, '_start_services') as start:
+            self.assertFalse(self.controller._switch_to_art_mode())
+        start.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()